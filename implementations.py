@@ -1,13 +1,13 @@
 import json
-from enum import Enum
+from enum import IntFlag
 
 IMPLEMENTATIONS = {}
 
 
-class Role(Enum):
-    BOTH = "both"
-    SERVER = "server"
-    CLIENT = "client"
+class Role(IntFlag):
+    SERVER = 1
+    CLIENT = 2
+    BOTH = SERVER | CLIENT
 
 
 with open("implementations.json", "r") as f:
@@ -1,29 +1,66 @@
-import json
+import concurrent.futures
+import errno
 import logging
 import os
 import random
 import re
+import shlex
 import shutil
+import signal
 import statistics
 import string
 import subprocess
 import sys
 import tempfile
+import threading
+from collections import defaultdict
 from datetime import datetime
-from typing import Callable, List, Tuple
+from typing import Callable, List, Optional, Tuple
 
+import orjson
 import prettytable
 from termcolor import colored
 
 import testcases
 from result import TestResult
-from testcases import Perspective
+from testcases import DecodedOutput, Perspective
+
+# Compliance is a property of the image, remember it across runs.
+# The cache is keyed by image ID, so pulling a new image invalidates the entry.
+COMPLIANCE_CACHE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "quic-interop-runner",
+    "compliant.json",
+)
+
+COMPOSE = ["docker", "compose", "--env-file", "empty.env"]
+
+# Endpoints are expected to exit right away when asked to run an unknown test case.
+COMPLIANCE_CHECK_TIMEOUT = 60
+
+UNSUPPORTED_RE = re.compile(rb"exited with code 127|exit status 127")
+# the client exiting successfully, or an endpoint not supporting the test case
+EXIT_RE = re.compile(rb"client exited with code 0|exited with code 127|exit status 127")
 
 
 def random_string(length: int):
     """Generate a random string of fixed length"""
     letters = string.ascii_lowercase
-    return "".join(random.choice(letters) for i in range(length))
+    return "".join(random.choices(letters, k=length))
+
+
+def move_dir(src: str, dst: str):
+    """Move a directory, without copying it if src and dst are on the same file system.
+    An empty directory is left at src, so that it can be cleaned up as usual."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copytree(src, dst)
+    else:
+        os.mkdir(src)
 
 
 class MeasurementResult:
@@ -32,10 +69,12 @@ class MeasurementResult:
 
 
 class LogFileFormatter(logging.Formatter):
+    _ANSI_RE = re.compile(r"\x1B[@-_][0-?]*[ -/]*[@-~]")
+
     def format(self, record):
         msg = super(LogFileFormatter, self).format(record)
         # remove color control characters
-        return re.compile(r"\x1B[@-_][0-?]*[ -/]*[@-~]").sub("", msg)
+        return self._ANSI_RE.sub("", msg)
 
 
 class InteropRunner:
@@ -51,7 +90,7 @@ class InteropRunner:
     _markdown = False
     _log_dir = ""
     _save_files = False
-    _no_auto_unsupported = []
+    _no_auto_unsupported = set()
 
     def __init__(
         self,
@@ -74,6 +113,10 @@ class InteropRunner:
         else:
             console.setLevel(logging.INFO)
         logger.addHandler(console)
+        # removing large log directories can take a while, don't wait for it
+        self._cleanup_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._tmp_root = testcases.TMP_ROOT
+        logging.debug("Using %s for temporary files.", self._tmp_root)
         self._start_time = datetime.now()
         self._tests = tests
         self._measurements = measurements
@@ -83,26 +126,26 @@ class InteropRunner:
         self._markdown = markdown
         self._log_dir = log_dir
         self._save_files = save_files
-        self._no_auto_unsupported = no_auto_unsupported
+        self._no_auto_unsupported = set(no_auto_unsupported)
         if len(self._log_dir) == 0:
             self._log_dir = "logs_{:%Y-%m-%dT%H:%M:%S}".format(self._start_time)
         if os.path.exists(self._log_dir):
             sys.exit("Log dir " + self._log_dir + " already exists.")
         logging.info("Saving logs to %s.", self._log_dir)
-        for client, server in client_server_pairs:
-            for test in self._tests:
-                self.test_results.setdefault(server, {}).setdefault(
-                    client, {}
-                ).setdefault(test, {})
-            for measurement in measurements:
-                self.measurement_results.setdefault(server, {}).setdefault(
-                    client, {}
-                ).setdefault(measurement, {})
-
-    def _is_unsupported(self, lines: List[str]) -> bool:
-        return any("exited with code 127" in str(line) for line in lines) or any(
-            "exit status 127" in str(line) for line in lines
-        )
+        # Keep the logs of the running test inside the log dir, so that they are on
+        # the same file system and can be moved into place instead of copied.
+        # Created in run(), and removed once all tests have run.
+        self._log_tmp_root = os.path.abspath(os.path.join(self._log_dir, ".tmp"))
+        # results are indexed by [server][client][test]
+        self.test_results = defaultdict(lambda: defaultdict(dict))
+        self.measurement_results = defaultdict(lambda: defaultdict(dict))
+
+    def _is_unsupported(self, lines: List[bytes], role: Optional[str] = None) -> bool:
+        """check if an endpoint exited with status 127
+        If a role is given, only the output of that container is considered."""
+        if role is not None:
+            lines = [line for line in lines if line.lstrip().startswith(role.encode())]
+        return any(UNSUPPORTED_RE.search(line) for line in lines)
 
     def _check_impl_is_compliant(self, name: str) -> bool:
         """check if an implementation return UNSUPPORTED for unknown test cases"""
@@ -112,80 +155,209 @@ class InteropRunner:
             )
             return self.compliant[name]
 
-        client_log_dir = tempfile.TemporaryDirectory(dir="/tmp", prefix="logs_client_")
-        www_dir = tempfile.TemporaryDirectory(dir="/tmp", prefix="compliance_www_")
-        certs_dir = tempfile.TemporaryDirectory(dir="/tmp", prefix="compliance_certs_")
+        image = self._implementations[name]["image"]
+        image_id = self._get_image_id(image)
+        if image_id is not None and self._load_compliance_cache().get(image_id):
+            logging.debug("%s (%s) known to be compliant.", name, image_id)
+            self.compliant[name] = True
+            return True
+
+        client_log_dir = tempfile.TemporaryDirectory(
+            dir=self._tmp_root, prefix="logs_client_"
+        )
+        server_log_dir = tempfile.TemporaryDirectory(
+            dir=self._tmp_root, prefix="logs_server_"
+        )
+        www_dir = tempfile.TemporaryDirectory(
+            dir=self._tmp_root, prefix="compliance_www_"
+        )
+        certs_dir = tempfile.TemporaryDirectory(
+            dir=self._tmp_root, prefix="compliance_certs_"
+        )
         downloads_dir = tempfile.TemporaryDirectory(
-            dir="/tmp", prefix="compliance_downloads_"
+            dir=self._tmp_root, prefix="compliance_downloads_"
         )
 
         testcases.generate_cert_chain(certs_dir.name)
 
-        # check that the client is capable of returning UNSUPPORTED
+        # check that client and server are capable of returning UNSUPPORTED,
+        # running both in a single docker compose invocation
+        logging.debug("Checking compliance of %s client and server", name)
+        env = {
+            "CERTS": certs_dir.name,
+            "TESTCASE_CLIENT": random_string(6),
+            "TESTCASE_SERVER": random_string(6),
+            "SERVER_LOGS": server_log_dir.name,
+            "CLIENT_LOGS": client_log_dir.name,
+            "WWW": www_dir.name,
+            "DOWNLOADS": downloads_dir.name,
+            "SCENARIO": "simple-p2p --delay=15ms --bandwidth=10Mbps --queue=25",
+            "CLIENT": image,
+            "SERVER": image,
+        }
+        try:
+            output = subprocess.run(
+                COMPOSE + ["up", "--timeout", "0", "-V", "server", "client"],
+                env=dict(os.environ, **env),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                timeout=COMPLIANCE_CHECK_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired as e:
+            # At least one of them kept running instead of exiting with 127.
+            logging.error("%s client and server compliance check timed out.", name)
+            logging.debug("%s", DecodedOutput(e.output or b""))
+            r = subprocess.run(
+                COMPOSE + ["stop", "server", "client"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                timeout=60,
+            )
+            logging.debug("%s", DecodedOutput(r.stdout))
+            self.compliant[name] = False
+            return False
+        lines = output.stdout.splitlines()
+        if self._is_unsupported(lines, "client") and self._is_unsupported(
+            lines, "server"
+        ):
+            logging.debug("%s client and server compliant.", name)
+        else:
+            # Fall back to checking client and server one after the other.
+            # This tells which one is not compliant.
+            logging.debug("%s", DecodedOutput(output.stdout))
+            if not (
+                self._check_client_is_compliant(name, certs_dir, www_dir, downloads_dir)
+                and self._check_server_is_compliant(
+                    name, certs_dir, www_dir, downloads_dir
+                )
+            ):
+                self.compliant[name] = False
+                return False
+
+        # remember compliance test outcome
+        self.compliant[name] = True
+        if image_id is not None:
+            self._save_compliance(image_id)
+        return True
+
+    def _check_client_is_compliant(
+        self,
+        name: str,
+        certs_dir: tempfile.TemporaryDirectory,
+        www_dir: tempfile.TemporaryDirectory,
+        downloads_dir: tempfile.TemporaryDirectory,
+    ) -> bool:
+        """check that the client is capable of returning UNSUPPORTED"""
+        image = self._implementations[name]["image"]
         logging.debug("Checking compliance of %s client", name)
-        cmd = (
-            "CERTS=" + certs_dir.name + " "
-            "TESTCASE_CLIENT=" + random_string(6) + " "
-            "SERVER_LOGS=/dev/null "
-            "CLIENT_LOGS=" + client_log_dir.name + " "
-            "WWW=" + www_dir.name + " "
-            "DOWNLOADS=" + downloads_dir.name + " "
-            'SCENARIO="simple-p2p --delay=15ms --bandwidth=10Mbps --queue=25" '
-            "CLIENT=" + self._implementations[name]["image"] + " "
-            "SERVER="
-            + self._implementations[name]["image"]
-            + " "  # only needed so docker compose doesn't complain
-            "docker compose --env-file empty.env up --timeout 0 --abort-on-container-exit -V sim client"
+        client_log_dir = tempfile.TemporaryDirectory(
+            dir=self._tmp_root, prefix="logs_client_"
         )
+        env = {
+            "CERTS": certs_dir.name,
+            "TESTCASE_CLIENT": random_string(6),
+            "SERVER_LOGS": "/dev/null",
+            "CLIENT_LOGS": client_log_dir.name,
+            "WWW": www_dir.name,
+            "DOWNLOADS": downloads_dir.name,
+            "SCENARIO": "simple-p2p --delay=15ms --bandwidth=10Mbps --queue=25",
+            "CLIENT": image,
+            # only needed so docker compose doesn't complain
+            "SERVER": image,
+        }
         output = subprocess.run(
-            cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            COMPOSE
+            + ["up", "--timeout", "0", "--abort-on-container-exit", "-V"]
+            + ["sim", "client"],
+            env=dict(os.environ, **env),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
         )
         if not self._is_unsupported(output.stdout.splitlines()):
             logging.error("%s client not compliant.", name)
-            logging.debug("%s", output.stdout.decode("utf-8", errors="replace"))
-            self.compliant[name] = False
+            logging.debug("%s", DecodedOutput(output.stdout))
             return False
         logging.debug("%s client compliant.", name)
+        return True
 
-        # check that the server is capable of returning UNSUPPORTED
+    def _check_server_is_compliant(
+        self,
+        name: str,
+        certs_dir: tempfile.TemporaryDirectory,
+        www_dir: tempfile.TemporaryDirectory,
+        downloads_dir: tempfile.TemporaryDirectory,
+    ) -> bool:
+        """check that the server is capable of returning UNSUPPORTED"""
+        image = self._implementations[name]["image"]
         logging.debug("Checking compliance of %s server", name)
-        server_log_dir = tempfile.TemporaryDirectory(dir="/tmp", prefix="logs_server_")
-        cmd = (
-            "CERTS=" + certs_dir.name + " "
-            "TESTCASE_SERVER=" + random_string(6) + " "
-            "SERVER_LOGS=" + server_log_dir.name + " "
-            "CLIENT_LOGS=/dev/null "
-            "WWW=" + www_dir.name + " "
-            "DOWNLOADS=" + downloads_dir.name + " "
-            "CLIENT="
-            + self._implementations[name]["image"]
-            + " "  # only needed so docker compose doesn't complain
-            "SERVER=" + self._implementations[name]["image"] + " "
-            "docker compose --env-file empty.env up -V server"
+        server_log_dir = tempfile.TemporaryDirectory(
+            dir=self._tmp_root, prefix="logs_server_"
         )
+        env = {
+            "CERTS": certs_dir.name,
+            "TESTCASE_SERVER": random_string(6),
+            "SERVER_LOGS": server_log_dir.name,
+            "CLIENT_LOGS": "/dev/null",
+            "WWW": www_dir.name,
+            "DOWNLOADS": downloads_dir.name,
+            # only needed so docker compose doesn't complain
+            "CLIENT": image,
+            "SERVER": image,
+        }
         output = subprocess.run(
-            cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            COMPOSE + ["up", "-V", "server"],
+            env=dict(os.environ, **env),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
         )
         if not self._is_unsupported(output.stdout.splitlines()):
             logging.error("%s server not compliant.", name)
-            logging.debug("%s", output.stdout.decode("utf-8", errors="replace"))
-            self.compliant[name] = False
+            logging.debug("%s", DecodedOutput(output.stdout))
             return False
         logging.debug("%s server compliant.", name)
-
-        # remember compliance test outcome
-        self.compliant[name] = True
         return True
 
+    def _get_image_id(self, image: str) -> Optional[str]:
+        r = subprocess.run(
+            ["docker", "image", "inspect", "--format", "{{.Id}}", image],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        if r.returncode != 0:  # the image hasn't been pulled yet
+            return None
+        return r.stdout.decode("utf-8").strip() or None
+
+    def _load_compliance_cache(self) -> dict:
+        try:
+            with open(COMPLIANCE_CACHE, "rb") as f:
+                return orjson.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    def _save_compliance(self, image_id: str):
+        cache = self._load_compliance_cache()
+        cache[image_id] = True
+        try:
+            os.makedirs(os.path.dirname(COMPLIANCE_CACHE), exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(COMPLIANCE_CACHE), delete=False
+            ) as f:
+                f.write(orjson.dumps(cache))
+            os.replace(f.name, COMPLIANCE_CACHE)
+        except OSError as e:
+            logging.info("Could not save compliance cache: %s", e)
+
     def _postprocess_results(self):
-        clients = list(set(client for client, _ in self._client_server_pairs))
-        servers = list(set(server for _, server in self._client_server_pairs))
+        clients = list({client for client, _ in self._client_server_pairs})
+        servers = list({server for _, server in self._client_server_pairs})
         questionable = [TestResult.FAILED, TestResult.UNSUPPORTED]
         # If a client failed a test against all servers, make the test unsupported for the client
         if len(servers) > 1:
-            for c in set(clients) - set(self._no_auto_unsupported):
+            for c in set(clients) - self._no_auto_unsupported:
                 for t in self._tests:
-                    if all(self.test_results[s][c][t] in questionable for s in servers):
+                    if all(
+                        self.test_results[s][c].get(t) in questionable for s in servers
+                    ):
                         print(
                             f"Client {c} failed or did not support test {t.name()} "
                             + 'against all servers, marking the entire test as "unsupported"'
@@ -194,9 +366,11 @@ class InteropRunner:
                             self.test_results[s][c][t] = TestResult.UNSUPPORTED
         # If a server failed a test against all clients, make the test unsupported for the server
         if len(clients) > 1:
-            for s in set(servers) - set(self._no_auto_unsupported):
+            for s in set(servers) - self._no_auto_unsupported:
                 for t in self._tests:
-                    if all(self.test_results[s][c][t] in questionable for c in clients):
+                    if all(
+                        self.test_results[s][c].get(t) in questionable for c in clients
+                    ):
                         print(
                             f"Server {s} failed or did not support test {t.name()} "
                             + 'against all clients, marking the entire test as "unsupported"'
@@ -204,90 +378,73 @@ class InteropRunner:
                         for c in clients:
                             self.test_results[s][c][t] = TestResult.UNSUPPORTED
 
+    def _print_table(self, get_cell: Callable[[str, str], str]):
+        """print a table with a row per client and a column per server"""
+        t = prettytable.PrettyTable()
+        if self._markdown:
+            t.set_style(prettytable.MARKDOWN)
+        else:
+            t.hrules = prettytable.ALL
+            t.vrules = prettytable.ALL
+        rows = {}
+        columns = {}
+        for client, server in self._client_server_pairs:
+            columns[server] = {}
+            row = rows.setdefault(client, {})
+            row[server] = get_cell(server, client)
+        t.field_names = [""] + list(columns)
+        for client, results in rows.items():
+            t.add_row([client] + [results.get(server, "") for server in columns])
+        print(t)
+
     def _print_results(self):
         """print the interop table"""
         logging.info("Run took %s", datetime.now() - self._start_time)
 
-        def get_letters(result):
-            return (
-                result.symbol()
-                + "("
-                + ",".join(
-                    [test.abbreviation() for test in cell if cell[test] is result]
-                )
-                + ")"
-            )
+        def get_letters(letters, result):
+            return result.symbol() + "(" + ",".join(letters[result]) + ")"
+
+        def get_test_cell(server: str, client: str) -> str:
+            cell = self.test_results[server][client]
+            letters = {result: [] for result in TestResult}
+            for test, result in cell.items():
+                letters[result].append(test.abbreviation())
+            br = "<br>" if self._markdown else "\n"
+            res = colored(get_letters(letters, TestResult.SUCCEEDED), "green") + br
+            res += colored(get_letters(letters, TestResult.UNSUPPORTED), "grey") + br
+            res += colored(get_letters(letters, TestResult.FAILED), "red")
+            return res
+
+        def get_measurement_cell(server: str, client: str) -> str:
+            cell = self.measurement_results[server][client]
+            results = []
+            for measurement in self._measurements:
+                res = cell.get(measurement)
+                if not hasattr(res, "result"):
+                    continue
+                if res.result == TestResult.SUCCEEDED:
+                    results.append(
+                        colored(
+                            measurement.abbreviation() + ": " + res.details,
+                            "green",
+                        )
+                    )
+                elif res.result == TestResult.UNSUPPORTED:
+                    results.append(colored(measurement.abbreviation(), "grey"))
+                elif res.result == TestResult.FAILED:
+                    results.append(colored(measurement.abbreviation(), "red"))
+            return "\n".join(results)
 
         if len(self._tests) > 0:
-            t = prettytable.PrettyTable()
-            if self._markdown:
-                t.set_style(prettytable.MARKDOWN)
-            else:
-                t.hrules = prettytable.ALL
-                t.vrules = prettytable.ALL
-            rows = {}
-            columns = {}
-            for client, server in self._client_server_pairs:
-                columns[server] = {}
-                row = rows.setdefault(client, {})
-                cell = self.test_results[server][client]
-                br = "<br>" if self._markdown else "\n"
-                res = colored(get_letters(TestResult.SUCCEEDED), "green") + br
-                res += colored(get_letters(TestResult.UNSUPPORTED), "grey") + br
-                res += colored(get_letters(TestResult.FAILED), "red")
-                row[server] = res
-
-            t.field_names = [""] + [column for column, _ in columns.items()]
-            for client, results in rows.items():
-                row = [client]
-                for server, _ in columns.items():
-                    row += [results.setdefault(server, "")]
-                t.add_row(row)
-            print(t)
-
+            self._print_table(get_test_cell)
         if len(self._measurements) > 0:
-            t = prettytable.PrettyTable()
-            if self._markdown:
-                t.set_style(prettytable.MARKDOWN)
-            else:
-                t.hrules = prettytable.ALL
-                t.vrules = prettytable.ALL
-            rows = {}
-            columns = {}
-            for client, server in self._client_server_pairs:
-                columns[server] = {}
-                row = rows.setdefault(client, {})
-                cell = self.measurement_results[server][client]
-                results = []
-                for measurement in self._measurements:
-                    res = cell[measurement]
-                    if not hasattr(res, "result"):
-                        continue
-                    if res.result == TestResult.SUCCEEDED:
-                        results.append(
-                            colored(
-                                measurement.abbreviation() + ": " + res.details,
-                                "green",
-                            )
-                        )
-                    elif res.result == TestResult.UNSUPPORTED:
-                        results.append(colored(measurement.abbreviation(), "grey"))
-                    elif res.result == TestResult.FAILED:
-                        results.append(colored(measurement.abbreviation(), "red"))
-                row[server] = "\n".join(results)
-            t.field_names = [""] + [column for column, _ in columns.items()]
-            for client, results in rows.items():
-                row = [client]
-                for server, _ in columns.items():
-                    row += [results.setdefault(server, "")]
-                t.add_row(row)
-            print(t)
+            self._print_table(get_measurement_cell)
 
     def _export_results(self):
         if not self._output:
             return
-        clients = list(set(client for client, _ in self._client_server_pairs))
-        servers = list(set(server for _, server in self._client_server_pairs))
+        clients = list({client for client, _ in self._client_server_pairs})
+        servers = list({server for _, server in self._client_server_pairs})
         out = {
             "start_time": self._start_time.timestamp(),
             "end_time": datetime.now().timestamp(),
@@ -310,11 +467,13 @@ class InteropRunner:
 
         for client in clients:
             for server in servers:
+                cell = self.test_results[server][client]
                 results = []
                 for test in self._tests:
                     r = None
-                    if hasattr(self.test_results[server][client][test], "value"):
-                        r = self.test_results[server][client][test].value
+                    res = cell.get(test)
+                    if hasattr(res, "value"):
+                        r = res.value
                     results.append(
                         {
                             "abbr": test.abbreviation(),
@@ -324,9 +483,10 @@ class InteropRunner:
                     )
                 out["results"].append(results)
 
+                cell = self.measurement_results[server][client]
                 measurements = []
                 for measurement in self._measurements:
-                    res = self.measurement_results[server][client][measurement]
+                    res = cell.get(measurement)
                     if not hasattr(res, "result"):
                         continue
                     measurements.append(
@@ -339,20 +499,14 @@ class InteropRunner:
                     )
                 out["measurements"].append(measurements)
 
-        f = open(self._output, "w")
-        json.dump(out, f)
-        f.close()
+        with open(self._output, "wb") as f:
+            f.write(orjson.dumps(out))
 
-    def _copy_logs(self, container: str, dir: tempfile.TemporaryDirectory):
-        cmd = (
-            "docker cp \"$(docker ps -a --format '{{.ID}} {{.Names}}' | awk '/^.* "
-            + container
-            + "$/ {print $1}')\":/logs/. "
-            + dir.name
-        )
+    def _copy_logs(self, container: str, dir: str):
+        # The compose file sets the container names,
+        # so there's no need to ask docker compose for the container IDs.
         r = subprocess.run(
-            cmd,
-            shell=True,
+            ["docker", "cp", container + ":/logs/.", dir],
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         )
@@ -360,9 +514,31 @@ class InteropRunner:
             logging.info(
                 "Copying logs from %s failed: %s",
                 container,
-                r.stdout.decode("utf-8", errors="replace"),
+                DecodedOutput(r.stdout),
             )
 
+    def _cleanup_test(
+        self, testcase: testcases.TestCase, log_dir: tempfile.TemporaryDirectory
+    ):
+        try:
+            testcase.cleanup()
+        finally:
+            log_dir.cleanup()
+
+    def _stop_containers(self, containers: List[str]):
+        r = subprocess.run(
+            COMPOSE + ["stop"] + containers,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=60,
+        )
+        logging.debug("%s", DecodedOutput(r.stdout))
+
+    def _log_cleanup_failure(self, future: concurrent.futures.Future):
+        # e.g. files written by the containers that can't be removed
+        if future.exception() is not None:
+            logging.info("Removing test directories failed: %s", future.exception())
+
     def _run_testcase(
         self, server: str, client: str, test: Callable[[], testcases.TestCase]
     ) -> TestResult:
@@ -376,11 +552,17 @@ class InteropRunner:
         test: Callable[[], testcases.TestCase],
     ) -> Tuple[TestResult, float]:
         start_time = datetime.now()
-        sim_log_dir = tempfile.TemporaryDirectory(dir="/tmp", prefix="logs_sim_")
-        server_log_dir = tempfile.TemporaryDirectory(dir="/tmp", prefix="logs_server_")
-        client_log_dir = tempfile.TemporaryDirectory(dir="/tmp", prefix="logs_client_")
-        log_file = tempfile.NamedTemporaryFile(dir="/tmp", prefix="output_log_")
-        log_handler = logging.FileHandler(log_file.name)
+        # one directory holds the logs of all containers and the test's output
+        tmp_log_dir = tempfile.TemporaryDirectory(
+            dir=self._log_tmp_root, prefix="logs_"
+        )
+        for container in ["sim", "server", "client"]:
+            os.mkdir(tmp_log_dir.name + "/" + container)
+        sim_log_dir = tmp_log_dir.name + "/sim"
+        server_log_dir = tmp_log_dir.name + "/server"
+        client_log_dir = tmp_log_dir.name + "/client"
+        log_file = tmp_log_dir.name + "/output.txt"
+        log_handler = logging.FileHandler(log_file)
         log_handler.setLevel(logging.DEBUG)
 
         formatter = LogFileFormatter("%(asctime)s %(message)s")
@@ -389,8 +571,8 @@ class InteropRunner:
 
         testcase = test(
             sim_log_dir=sim_log_dir,
-            client_keylog_file=client_log_dir.name + "/keys.log",
-            server_keylog_file=server_log_dir.name + "/keys.log",
+            client_keylog_file=client_log_dir + "/keys.log",
+            server_keylog_file=server_log_dir + "/keys.log",
         )
         print(
             "Server: "
@@ -401,70 +583,115 @@ class InteropRunner:
             + str(testcase)
         )
 
-        reqs = " ".join([testcase.urlprefix() + p for p in testcase.get_paths()])
+        prefix = testcase.urlprefix()
+        reqs = " ".join(prefix + p for p in testcase.get_paths())
         logging.debug("Requests: %s", reqs)
-        params = (
-            "WAITFORSERVER=server:443 "
-            "CERTS=" + testcase.certs_dir() + " "
-            "TESTCASE_SERVER=" + testcase.testname(Perspective.SERVER) + " "
-            "TESTCASE_CLIENT=" + testcase.testname(Perspective.CLIENT) + " "
-            "WWW=" + testcase.www_dir() + " "
-            "DOWNLOADS=" + testcase.download_dir() + " "
-            "SERVER_LOGS=" + server_log_dir.name + " "
-            "CLIENT_LOGS=" + client_log_dir.name + " "
-            'SCENARIO="{}" '
-            "CLIENT=" + self._implementations[client]["image"] + " "
-            "SERVER=" + self._implementations[server]["image"] + " "
-            'REQUESTS="' + reqs + '" '
-        ).format(testcase.scenario())
-        params += " ".join(testcase.additional_envs())
-        containers = "sim client server " + " ".join(testcase.additional_containers())
-        cmd = (
-            params
-            + " docker compose --env-file empty.env up --abort-on-container-exit --timeout 1 "
-            + containers
+        env = {
+            "WAITFORSERVER": "server:443",
+            "CERTS": testcase.certs_dir(),
+            "TESTCASE_SERVER": testcase.testname(Perspective.SERVER),
+            "TESTCASE_CLIENT": testcase.testname(Perspective.CLIENT),
+            "WWW": testcase.www_dir(),
+            "DOWNLOADS": testcase.download_dir(),
+            "SERVER_LOGS": server_log_dir,
+            "CLIENT_LOGS": client_log_dir,
+            "SCENARIO": testcase.scenario(),
+            "CLIENT": self._implementations[client]["image"],
+            "SERVER": self._implementations[server]["image"],
+            "REQUESTS": reqs,
+        }
+        for e in testcase.additional_envs():
+            if e:
+                key, value = e.split("=", 1)
+                env[key] = value
+        containers = ["sim", "client", "server"] + [
+            c for c in testcase.additional_containers() if c
+        ]
+        cmd = COMPOSE + ["up", "--abort-on-container-exit", "--timeout", "1"]
+        cmd += containers
+        logging.debug(
+            "Command: %s",
+            " ".join([k + "=" + shlex.quote(v) for k, v in env.items()] + cmd),
         )
-        logging.debug("Command: %s", cmd)
 
         status = TestResult.FAILED
-        output = ""
-        expired = False
+        # Scan the output while it is being read,
+        # instead of searching through all of it after the run.
+        output = []
+        unsupported = False
+        client_succeeded = False
+        # Run compose in its own process group. The docker CLI starts the compose
+        # plugin as a separate process that shares the output pipe, so both of
+        # them need to be killed for the pipe to be closed.
+        proc = subprocess.Popen(
+            cmd,
+            env=dict(os.environ, **env),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        timed_out = threading.Event()
+
+        def kill_group() -> bool:
+            if proc.poll() is not None:  # already exited
+                return False
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                return False
+            return True
+
+        def kill():
+            if kill_group():
+                timed_out.set()
+
+        timer = threading.Timer(testcase.timeout(), kill)
+        timer.start()
         try:
-            r = subprocess.run(
-                cmd,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                timeout=testcase.timeout(),
-            )
-            output = r.stdout
-        except subprocess.TimeoutExpired as ex:
-            output = ex.stdout
-            expired = True
-
-        logging.debug("%s", output.decode("utf-8", errors="replace"))
+            for line in proc.stdout:
+                output.append(line)
+                m = EXIT_RE.search(line)
+                if m is None:
+                    continue
+                if m.group() == b"client exited with code 0":
+                    client_succeeded = True
+                else:
+                    unsupported = True
+            proc.wait()
+        except BaseException:
+            # e.g. KeyboardInterrupt, don't leave compose or the containers running
+            kill_group()
+            proc.wait()
+            self._stop_containers(containers)
+            raise
+        finally:
+            proc.stdout.close()
+            timer.cancel()
+            # wait for kill() to finish, in case the timer just fired
+            timer.join()
+        expired = timed_out.is_set()
+
+        logging.debug("%s", DecodedOutput(b"".join(output)))
 
         if expired:
             logging.debug("Test failed: took longer than %ds.", testcase.timeout())
-            r = subprocess.run(
-                "docker compose --env-file empty.env stop " + containers,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                timeout=60,
-            )
-            logging.debug("%s", r.stdout.decode("utf-8", errors="replace"))
-
-        # copy the pcaps from the simulator
-        self._copy_logs("sim", sim_log_dir)
-        self._copy_logs("client", client_log_dir)
-        self._copy_logs("server", server_log_dir)
-
-        if not expired:
-            lines = output.splitlines()
-            if self._is_unsupported(lines):
-                status = TestResult.UNSUPPORTED
-            elif any("client exited with code 0" in str(line) for line in lines):
+            self._stop_containers(containers)
+
+        if not expired and unsupported:
+            # the logs of unsupported tests are not saved
+            status = TestResult.UNSUPPORTED
+        else:
+            # copy the pcaps from the simulator, and the logs of the endpoints
+            with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+                copies = [
+                    executor.submit(self._copy_logs, "sim", sim_log_dir),
+                    executor.submit(self._copy_logs, "client", client_log_dir),
+                    executor.submit(self._copy_logs, "server", server_log_dir),
+                ]
+            for copy in copies:
+                copy.result()
+
+            if not expired and client_succeeded:
                 try:
                     status = testcase.check()
                 except FileNotFoundError as e:
@@ -478,21 +705,21 @@ class InteropRunner:
             log_dir = self._log_dir + "/" + server + "_" + client + "/" + str(testcase)
             if log_dir_prefix:
                 log_dir += "/" + log_dir_prefix
-            shutil.copytree(server_log_dir.name, log_dir + "/server")
-            shutil.copytree(client_log_dir.name, log_dir + "/client")
-            shutil.copytree(sim_log_dir.name, log_dir + "/sim")
-            shutil.copyfile(log_file.name, log_dir + "/output.txt")
+            move_dir(server_log_dir, log_dir + "/server")
+            move_dir(client_log_dir, log_dir + "/client")
+            move_dir(sim_log_dir, log_dir + "/sim")
+            shutil.copyfile(log_file, log_dir + "/output.txt")
             if self._save_files and status == TestResult.FAILED:
-                shutil.copytree(testcase.www_dir(), log_dir + "/www")
+                move_dir(testcase.www_dir(), log_dir + "/www")
                 try:
-                    shutil.copytree(testcase.download_dir(), log_dir + "/downloads")
+                    move_dir(testcase.download_dir(), log_dir + "/downloads")
                 except Exception as exception:
                     logging.info("Could not copy downloaded files: %s", exception)
 
-        testcase.cleanup()
-        server_log_dir.cleanup()
-        client_log_dir.cleanup()
-        sim_log_dir.cleanup()
+        cleanup = self._cleanup_executor.submit(
+            self._cleanup_test, testcase, tmp_log_dir
+        )
+        cleanup.add_done_callback(self._log_cleanup_failure)
         logging.debug(
             "Test: %s took %ss, status: %s",
             str(testcase),
@@ -509,7 +736,10 @@ class InteropRunner:
         return status, value
 
     def _run_measurement(
-        self, server: str, client: str, test: Callable[[], testcases.Measurement]
+        self,
+        server: str,
+        client: str,
+        test: Callable[[], testcases.Measurement],
     ) -> MeasurementResult:
         values = []
         for i in range(0, test.repetitions()):
@@ -532,10 +762,13 @@ class InteropRunner:
     def run(self):
         """run the interop test suite and output the table"""
 
-        nr_failed = 0
+        # Only one docker compose project can run at a time: the compose file
+        # fixes the container names and the addresses of the simulated network.
+        # Check the compliance of all pairs up front, and then run all tests.
+        runs = []
         for client, server in self._client_server_pairs:
             logging.debug(
-                "Running with server %s (%s) and client %s (%s)",
+                "Checking compliance of server %s (%s) and client %s (%s)",
                 server,
                 self._implementations[server]["image"],
                 client,
@@ -547,18 +780,42 @@ class InteropRunner:
             ):
                 logging.info("Not compliant, skipping")
                 continue
+            for test in self._tests + self._measurements:
+                runs.append((server, client, test))
 
-            # run the test cases
-            for testcase in self._tests:
-                status = self._run_testcase(server, client, testcase)
-                self.test_results[server][client][testcase] = status
-                if status == TestResult.FAILED:
-                    nr_failed += 1
-
-            # run the measurements
-            for measurement in self._measurements:
-                res = self._run_measurement(server, client, measurement)
-                self.measurement_results[server][client][measurement] = res
+        nr_failed = 0
+        os.makedirs(self._log_tmp_root)
+        try:
+            pair = None
+            for server, client, test in runs:
+                if (server, client) != pair:
+                    pair = (server, client)
+                    logging.debug(
+                        "Running with server %s (%s) and client %s (%s)",
+                        server,
+                        self._implementations[server]["image"],
+                        client,
+                        self._implementations[client]["image"],
+                    )
+                if issubclass(test, testcases.Measurement):
+                    res = self._run_measurement(server, client, test)
+                    self.measurement_results[server][client][test] = res
+                else:
+                    status = self._run_testcase(server, client, test)
+                    self.test_results[server][client][test] = status
+                    if status == TestResult.FAILED:
+                        nr_failed += 1
+        finally:
+            self._cleanup_executor.shutdown()
+            try:
+                shutil.rmtree(self._log_tmp_root)
+            except OSError as e:
+                logging.info("Removing %s failed: %s", self._log_tmp_root, e)
+            # don't leave an empty log dir behind if no logs were saved
+            try:
+                os.rmdir(self._log_dir)
+            except OSError:
+                pass
 
         self._postprocess_results()
         self._print_results()
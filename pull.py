@@ -1,15 +1,10 @@
 import argparse
-import os
+import concurrent.futures
+import subprocess
 import sys
 
 from implementations import IMPLEMENTATIONS
 
-print("Pulling the simulator...")
-os.system("docker pull martenseemann/quic-network-simulator")
-
-print("\nPulling the iperf endpoint...")
-os.system("docker pull martenseemann/quic-interop-iperf-endpoint")
-
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -17,15 +12,32 @@ def get_args():
     return parser.parse_args()
 
 
+args = get_args()
 implementations = {}
-if get_args().implementations:
-    for s in get_args().implementations.split(","):
+if args.implementations:
+    for s in args.implementations.split(","):
         if s not in [n for n, _ in IMPLEMENTATIONS.items()]:
             sys.exit("implementation " + s + " not found.")
         implementations[s] = IMPLEMENTATIONS[s]
 else:
     implementations = IMPLEMENTATIONS
 
+images = {
+    "the simulator": "martenseemann/quic-network-simulator",
+    "the iperf endpoint": "martenseemann/quic-interop-iperf-endpoint",
+}
 for name, value in implementations.items():
-    print("\nPulling " + name + "...")
-    os.system("docker pull " + value["image"])
+    images[name] = value["image"]
+
+
+def pull(image: str) -> subprocess.CompletedProcess:
+    # buffer the output, so that the progress of parallel pulls doesn't interleave
+    return subprocess.run(
+        ["docker", "pull", image], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(images))) as ex:
+    for name, r in zip(images, ex.map(pull, images.values())):
+        print("\nPulling " + name + "...")
+        print(r.stdout.decode("utf-8", errors="replace"), end="")
@@ -1,28 +1,30 @@
 #!/usr/bin/env python3
 
 import argparse
+import itertools
 import sys
 from typing import List, Tuple
 
 import testcases
-from implementations import IMPLEMENTATIONS, Role
-from interop import InteropRunner
 from testcases import MEASUREMENTS, TESTCASES
 
-implementations = {
-    name: {"image": value["image"], "url": value["url"]}
-    for name, value in IMPLEMENTATIONS.items()
-}
-client_implementations = [
-    name
-    for name, value in IMPLEMENTATIONS.items()
-    if value["role"] == Role.BOTH or value["role"] == Role.CLIENT
-]
-server_implementations = [
-    name
-    for name, value in IMPLEMENTATIONS.items()
-    if value["role"] == Role.BOTH or value["role"] == Role.SERVER
-]
+
+def get_implementations() -> Tuple[dict, List[str], List[str]]:
+    """split the implementations into clients and servers, in a single pass"""
+    # implementations.json is only read once the arguments have been parsed
+    from implementations import IMPLEMENTATIONS, Role
+
+    implementations = {}
+    client_implementations = []
+    server_implementations = []
+    for name, value in IMPLEMENTATIONS.items():
+        implementations[name] = {"image": value["image"], "url": value["url"]}
+        role = value["role"]
+        if role & Role.CLIENT:
+            client_implementations.append(name)
+        if role & Role.SERVER:
+            server_implementations.append(name)
+    return implementations, client_implementations, server_implementations
 
 
 def main():
@@ -46,7 +48,11 @@ def main():
             "-t",
             "--test",
             help="test cases (comma-separatated). Valid test cases are: "
-            + ", ".join([x.name() for x in TESTCASES + MEASUREMENTS]),
+            + ", ".join(
+                itertools.chain(
+                    testcases.TESTCASES_BY_NAME, testcases.MEASUREMENTS_BY_NAME
+                )
+            ),
         )
         parser.add_argument(
             "-r",
@@ -85,14 +91,19 @@ def main():
         )
         return parser.parse_args()
 
-    replace_arg = get_args().replace
+    args = get_args()
+    (
+        implementations,
+        client_implementations,
+        server_implementations,
+    ) = get_implementations()
+    replace_arg = args.replace
     if replace_arg:
         for s in replace_arg.split(","):
-            pair = s.split("=")
-            if len(pair) != 2:
+            name, sep, image = s.partition("=")
+            if not sep:
                 sys.exit("Invalid format for replace")
-            name, image = pair[0], pair[1]
-            if name not in IMPLEMENTATIONS:
+            if name not in implementations:
                 sys.exit("Implementation " + name + " not found.")
             implementations[name]["image"] = image
 
@@ -107,16 +118,10 @@ def main():
         return impls
 
     def get_impl_pairs(clients, servers, must_include) -> List[Tuple[str, str]]:
-        impls = []
-        for client in clients:
-            for server in servers:
-                if (
-                    must_include is None
-                    or client == must_include
-                    or server == must_include
-                ):
-                    impls.append((client, server))
-        return impls
+        impls = list(itertools.product(clients, servers))
+        if must_include is None:
+            return impls
+        return [pair for pair in impls if must_include in pair]
 
     def get_tests_and_measurements(
         arg,
@@ -129,52 +134,54 @@ def main():
             return [], MEASUREMENTS
         elif not arg:
             return []
+        test_lookup = testcases.TESTCASES_BY_NAME
+        measurement_lookup = testcases.MEASUREMENTS_BY_NAME
         tests = []
         measurements = []
         for t in arg.split(","):
-            if t in [tc.name() for tc in TESTCASES]:
-                tests += [tc for tc in TESTCASES if tc.name() == t]
-            elif t in [tc.name() for tc in MEASUREMENTS]:
-                measurements += [tc for tc in MEASUREMENTS if tc.name() == t]
+            if t in test_lookup:
+                tests.append(test_lookup[t])
+            elif t in measurement_lookup:
+                measurements.append(measurement_lookup[t])
             else:
-                print(
+                sys.exit(
                     (
                         "Test case {} not found.\n"
                         "Available testcases: {}\n"
                         "Available measurements: {}"
                     ).format(
                         t,
-                        ", ".join([t.name() for t in TESTCASES]),
-                        ", ".join([t.name() for t in MEASUREMENTS]),
+                        ", ".join(test_lookup),
+                        ", ".join(measurement_lookup),
                     )
                 )
-                sys.exit()
         return tests, measurements
 
-    t = get_tests_and_measurements(get_args().test)
-    clients = get_impls(get_args().client, client_implementations, "Client")
-    servers = get_impls(get_args().server, server_implementations, "Server")
+    t = get_tests_and_measurements(args.test)
+    clients = get_impls(args.client, client_implementations, "Client")
+    servers = get_impls(args.server, server_implementations, "Server")
     # If there is only one client or server, we should not automatically mark tests as unsupported
     no_auto_unsupported = set()
     for kind in [clients, servers]:
         if len(kind) == 1:
             no_auto_unsupported.add(kind[0])
+    # only import the runner once the arguments are known to be valid
+    from interop import InteropRunner
+
     return InteropRunner(
         implementations=implementations,
-        client_server_pairs=get_impl_pairs(clients, servers, get_args().must_include),
+        client_server_pairs=get_impl_pairs(clients, servers, args.must_include),
         tests=t[0],
         measurements=t[1],
-        output=get_args().json,
-        markdown=get_args().markdown,
-        debug=get_args().debug,
-        log_dir=get_args().log_dir,
-        save_files=get_args().save_files,
+        output=args.json,
+        markdown=args.markdown,
+        debug=args.debug,
+        log_dir=args.log_dir,
+        save_files=args.save_files,
         no_auto_unsupported=(
             no_auto_unsupported
-            if get_args().no_auto_unsupported is None
-            else get_impls(
-                get_args().no_auto_unsupported, clients + servers, "Client/Server"
-            )
+            if args.no_auto_unsupported is None
+            else get_impls(args.no_auto_unsupported, clients + servers, "Client/Server")
         ),
     ).run()
 
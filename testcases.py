@@ -1,14 +1,13 @@
 import abc
-import filecmp
+import hashlib
 import logging
 import os
 import random
-import re
-import shutil
 import string
 import subprocess
 import sys
 import tempfile
+import threading
 from datetime import timedelta
 from enum import Enum, IntEnum
 from trace import (
@@ -28,6 +27,24 @@ from result import TestResult
 KB = 1 << 10
 MB = 1 << 20
 
+RANDOM_FILE_CHUNK_SIZE = 1 * MB
+RANDOM_FILE_CHUNK = bytes(RANDOM_FILE_CHUNK_SIZE)
+
+
+def _get_tmp_root() -> str:
+    """Pick the directory for transient test files.
+    Set QIR_TMPDIR to use a tmpfs (e.g. /dev/shm), so that files that only live
+    for the duration of a test case don't need to be written to disk.
+    This is opt-in: some test cases need a lot of space, and tmpfs is backed by RAM."""
+    d = os.environ.get("QIR_TMPDIR")
+    if d and os.path.isdir(d) and os.access(d, os.W_OK | os.X_OK):
+        return d
+    # not tempfile.gettempdir(): TMPDIR might not be shared with the Docker daemon
+    return "/tmp"
+
+
+TMP_ROOT = _get_tmp_root()
+
 QUIC_DRAFT = 34  # draft-34
 QUIC_VERSION = hex(0x1)
 
@@ -47,40 +64,79 @@ class ECN(IntEnum):
 def random_string(length: int):
     """Generate a random string of fixed length"""
     letters = string.ascii_lowercase
-    return "".join(random.choice(letters) for i in range(length))
+    return "".join(random.choices(letters, k=length))
+
+
+def file_digest(path: str) -> bytes:
+    """Hash a file, without reading all of it into memory"""
+    # SHA-256 uses the SHA extensions of the CPU where available.
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(RANDOM_FILE_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+class DecodedOutput:
+    """Decodes the output of a subprocess only when a log record is formatted"""
+
+    def __init__(self, output: bytes):
+        self._output = output
+
+    def __str__(self):
+        return self._output.decode("utf-8", errors="replace")
 
 
 def generate_cert_chain(directory: str, length: int = 1):
-    cmd = "./certs.sh " + directory + " " + str(length)
     r = subprocess.run(
-        cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        ["./certs.sh", directory, str(length)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
     )
-    logging.debug("%s", r.stdout.decode("utf-8"))
+    logging.debug("%s", DecodedOutput(r.stdout))
     if r.returncode != 0:
         logging.info("Unable to create certificates")
         sys.exit(1)
 
 
+# Generating a certificate chain is expensive.
+# All test cases share one chain per chain length, for the lifetime of the process.
+_cert_dirs = {}
+_cert_dirs_lock = threading.Lock()
+
+
+def get_cert_dir(length: int = 1) -> str:
+    with _cert_dirs_lock:
+        if length not in _cert_dirs:
+            cert_dir = tempfile.TemporaryDirectory(dir=TMP_ROOT, prefix="certs_")
+            generate_cert_chain(cert_dir.name, length)
+            _cert_dirs[length] = cert_dir
+        return _cert_dirs[length].name + "/"
+
+
 class TestCase(abc.ABC):
     _files = []
+    _file_digests = {}
     _www_dir = None
     _client_keylog_file = None
     _server_keylog_file = None
     _download_dir = None
     _sim_log_dir = None
-    _cert_dir = None
     _cached_server_trace = None
     _cached_client_trace = None
+    _cached_keylog_file = None
+    _keylog_file_checked = False
 
     def __init__(
         self,
-        sim_log_dir: tempfile.TemporaryDirectory,
+        sim_log_dir: str,
         client_keylog_file: str,
         server_keylog_file: str,
     ):
         self._server_keylog_file = server_keylog_file
         self._client_keylog_file = client_keylog_file
         self._files = []
+        self._file_digests = {}
         self._sim_log_dir = sim_log_dir
 
     @abc.abstractmethod
@@ -123,34 +179,41 @@ class TestCase(abc.ABC):
 
     def www_dir(self):
         if not self._www_dir:
-            self._www_dir = tempfile.TemporaryDirectory(dir="/tmp", prefix="www_")
+            self._www_dir = tempfile.TemporaryDirectory(dir=TMP_ROOT, prefix="www_")
         return self._www_dir.name + "/"
 
     def download_dir(self):
         if not self._download_dir:
             self._download_dir = tempfile.TemporaryDirectory(
-                dir="/tmp", prefix="download_"
+                dir=TMP_ROOT, prefix="download_"
             )
         return self._download_dir.name + "/"
 
     def certs_dir(self):
-        if not self._cert_dir:
-            self._cert_dir = tempfile.TemporaryDirectory(dir="/tmp", prefix="certs_")
-            generate_cert_chain(self._cert_dir.name)
-        return self._cert_dir.name + "/"
+        return get_cert_dir()
 
     def _is_valid_keylog(self, filename) -> bool:
         if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
             return False
-        with open(filename, "r") as file:
-            if not re.search(
-                r"^SERVER_HANDSHAKE_TRAFFIC_SECRET", file.read(), re.MULTILINE
+        # read as bytes, there's no need to decode the secrets
+        with open(filename, "rb") as file:
+            # stop reading at the first matching line
+            if not any(
+                line.startswith(b"SERVER_HANDSHAKE_TRAFFIC_SECRET") for line in file
             ):
                 logging.info("Key log file %s is using incorrect format.", filename)
                 return False
         return True
 
     def _keylog_file(self) -> str:
+        # The key log files are complete once the endpoints have exited,
+        # so they only need to be validated once.
+        if not self._keylog_file_checked:
+            self._cached_keylog_file = self._find_keylog_file()
+            self._keylog_file_checked = True
+        return self._cached_keylog_file
+
+    def _find_keylog_file(self) -> str:
         if self._is_valid_keylog(self._client_keylog_file):
             logging.debug("Using the client's key log file.")
             return self._client_keylog_file
@@ -167,28 +230,34 @@ class TestCase(abc.ABC):
         if keylog is None:
             return
 
-        with tempfile.NamedTemporaryFile() as tmp:
+        # Write the new pcap next to the original one,
+        # so that it can be moved into place instead of being copied.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(trace))
+        os.close(fd)
+        try:
             r = subprocess.run(
-                f"editcap --inject-secrets tls,{keylog} {trace} {tmp.name}",
-                shell=True,
+                ["editcap", "--inject-secrets", "tls," + keylog, trace, tmp],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
             )
-            logging.debug("%s", r.stdout.decode("utf-8"))
-            if r.returncode != 0:
-                return
-            shutil.copy(tmp.name, trace)
+            logging.debug("%s", DecodedOutput(r.stdout))
+            if r.returncode == 0:
+                os.replace(tmp, trace)
+        finally:
+            # don't leave the temporary file behind in the logs
+            if os.path.exists(tmp):
+                os.remove(tmp)
 
     def _client_trace(self):
         if self._cached_client_trace is None:
-            trace = self._sim_log_dir.name + "/trace_node_left.pcap"
+            trace = self._sim_log_dir + "/trace_node_left.pcap"
             self._inject_keylog_if_possible(trace)
             self._cached_client_trace = TraceAnalyzer(trace, self._keylog_file())
         return self._cached_client_trace
 
     def _server_trace(self):
         if self._cached_server_trace is None:
-            trace = self._sim_log_dir.name + "/trace_node_right.pcap"
+            trace = self._sim_log_dir + "/trace_node_right.pcap"
             self._inject_keylog_if_possible(trace)
             self._cached_server_trace = TraceAnalyzer(trace, self._keylog_file())
         return self._cached_server_trace
@@ -196,10 +265,25 @@ class TestCase(abc.ABC):
     # see https://www.stefanocappellini.it/generate-pseudorandom-bytes-with-python/ for benchmarks
     def _generate_random_file(self, size: int, filename_len=10) -> str:
         filename = random_string(filename_len)
-        enc = AES.new(os.urandom(32), AES.MODE_OFB, b"a" * 16)
-        f = open(self.www_dir() + filename, "wb")
-        f.write(enc.encrypt(b" " * size))
-        f.close()
+        # AES-CTR uses AES-NI where available.
+        # Encrypt in chunks, so that large files don't have to be held in memory.
+        enc = AES.new(os.urandom(32), AES.MODE_CTR, nonce=b"")
+        # Hash the file while writing it,
+        # so that checking a download doesn't require reading it again.
+        h = hashlib.sha256()
+        with open(self.www_dir() + filename, "wb") as f:
+            chunks = size // RANDOM_FILE_CHUNK_SIZE
+            if chunks > 0:
+                # encrypt all full chunks into the same buffer
+                buf = bytearray(RANDOM_FILE_CHUNK_SIZE)
+                for _ in range(chunks):
+                    enc.encrypt(RANDOM_FILE_CHUNK, output=buf)
+                    h.update(buf)
+                    f.write(buf)
+            data = enc.encrypt(bytes(size % RANDOM_FILE_CHUNK_SIZE))
+            h.update(data)
+            f.write(data)
+        self._file_digests[filename] = h.digest()
         logging.debug("Generated random file: %s of size: %d", filename, size)
         return filename
 
@@ -207,7 +291,8 @@ class TestCase(abc.ABC):
         return len(self._client_trace().get_retry()) > 0
 
     def _check_version_and_files(self) -> bool:
-        versions = [hex(int(v, 0)) for v in self._get_versions()]
+        # normalize the versions, so that different spellings count as one version
+        versions = {hex(int(v, 0)) for v in self._get_versions()}
         if len(versions) != 1:
             logging.info("Expected exactly one version. Got %s", versions)
             return False
@@ -219,12 +304,12 @@ class TestCase(abc.ABC):
     def _check_files(self) -> bool:
         if len(self._files) == 0:
             raise Exception("No test files generated.")
-        files = [
-            n
-            for n in os.listdir(self.download_dir())
-            if os.path.isfile(os.path.join(self.download_dir(), n))
-        ]
-        too_many = [f for f in files if f not in self._files]
+        download_dir = self.download_dir()
+        # is_file() uses the file type returned by readdir, no need to stat every file
+        with os.scandir(download_dir) as it:
+            files = {e.name for e in it if e.is_file()}
+        expected = set(self._files)
+        too_many = [f for f in files if f not in expected]
         if len(too_many) != 0:
             logging.info("Found unexpected downloaded files: %s", too_many)
         too_few = [f for f in self._files if f not in files]
@@ -233,23 +318,22 @@ class TestCase(abc.ABC):
         if len(too_many) != 0 or len(too_few) != 0:
             return False
         for f in self._files:
-            fp = self.download_dir() + f
-            if not os.path.isfile(fp):
-                logging.info("File %s does not exist.", fp)
-                return False
+            fp = download_dir + f
             try:
-                size = os.path.getsize(self.www_dir() + f)
-                downloaded_size = os.path.getsize(fp)
-                if size != downloaded_size:
-                    logging.info(
-                        "File size of %s doesn't match. Original: %d bytes, downloaded: %d bytes.",
-                        fp,
-                        size,
-                        downloaded_size,
-                    )
-                    return False
-                if not filecmp.cmp(self.www_dir() + f, fp, shallow=False):
-                    logging.info("File contents of %s do not match.", fp)
+                # Files of different sizes have different digests.
+                # Only look at the sizes to explain a mismatch.
+                if file_digest(fp) != self._file_digests[f]:
+                    size = os.path.getsize(self.www_dir() + f)
+                    downloaded_size = os.path.getsize(fp)
+                    if size != downloaded_size:
+                        logging.info(
+                            "File size of %s doesn't match. Original: %d bytes, downloaded: %d bytes.",
+                            fp,
+                            size,
+                            downloaded_size,
+                        )
+                    else:
+                        logging.info("File contents of %s do not match.", fp)
                     return False
             except Exception as exception:
                 logging.info(
@@ -267,25 +351,26 @@ class TestCase(abc.ABC):
         tr = self._server_trace()
         # Determine the number of handshakes by looking at Initial packets.
         # This is easier, since the SCID of Initial packets doesn't changes.
-        return len(set([p.scid for p in tr.get_initial(Direction.FROM_SERVER)]))
+        return len({p.scid for p in tr.get_initial(Direction.FROM_SERVER)})
 
     def _get_versions(self) -> set:
         """Get the QUIC versions"""
         tr = self._server_trace()
-        return set([p.version for p in tr.get_initial(Direction.FROM_SERVER)])
+        return {p.version for p in tr.get_initial(Direction.FROM_SERVER)}
 
     def _payload_size(self, packets: List) -> int:
         """Get the sum of the payload sizes of all packets"""
+        # payloads are hex strings with the bytes separated by colons ("aa:bb:cc")
         size = 0
         for p in packets:
             if hasattr(p, "long_packet_type") or hasattr(p, "long_packet_type_v2"):
-                if hasattr(p, "payload"):  # when keys are available
-                    size += len(p.payload.split(":"))
-                else:
-                    size += len(p.remaining_payload.split(":"))
+                payload = getattr(p, "payload", None)  # when keys are available
+                if payload is None:
+                    payload = p.remaining_payload
             else:
-                if hasattr(p, "protected_payload"):
-                    size += len(p.protected_payload.split(":"))
+                payload = getattr(p, "protected_payload", None)
+            if payload is not None:
+                size += (len(payload) + 1) // 3
         return size
 
     def cleanup(self):
@@ -783,10 +868,7 @@ class TestCaseAmplificationLimit(TestCase):
         return "The server obeys the 3x amplification limit."
 
     def certs_dir(self):
-        if not self._cert_dir:
-            self._cert_dir = tempfile.TemporaryDirectory(dir="/tmp", prefix="certs_")
-            generate_cert_chain(self._cert_dir.name, 9)
-        return self._cert_dir.name + "/"
+        return get_cert_dir(9)
 
     @staticmethod
     def scenario() -> str:
@@ -1709,3 +1791,7 @@ MEASUREMENTS = [
     MeasurementGoodput,
     MeasurementCrossTraffic,
 ]
+
+# look up test cases and measurements by name, without calling name() every time
+TESTCASES_BY_NAME = {tc.name(): tc for tc in TESTCASES}
+MEASUREMENTS_BY_NAME = {m.name(): m for m in MEASUREMENTS}
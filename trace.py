@@ -3,8 +3,6 @@ import logging
 from enum import Enum
 from typing import List, Optional, Tuple
 
-import pyshark
-
 IP4_CLIENT = "193.167.0.100"
 IP4_SERVER = "193.167.100.100"
 IP6_CLIENT = "fd00:cafe:cafe:0::100"
@@ -83,6 +81,10 @@ class TraceAnalyzer:
     def __init__(self, filename: str, keylog_file: Optional[str] = None):
         self._filename = filename
         self._keylog_file = keylog_file
+        # Running tshark over the pcap is expensive, and so is every field access
+        # on the pyshark layers. All long header packet types are found in one pass,
+        # the raw packets are not kept.
+        self._long_header_packets = {}
 
     def _get_direction_filter(self, d: Direction) -> str:
         f = "(quic && !icmp) && "
@@ -98,6 +100,9 @@ class TraceAnalyzer:
             return f
 
     def _get_packets(self, f: str) -> List:
+        # pyshark is slow to import, and only needed once a trace is analyzed
+        import pyshark
+
         override_prefs = {}
         if self._keylog_file is not None:
             override_prefs["tls.keylog_file"] = self._keylog_file
@@ -166,25 +171,30 @@ class TraceAnalyzer:
     def _get_long_header_packets(
         self, packet_type: PacketType, direction: Direction
     ) -> List:
-        packets = []
+        if direction not in self._long_header_packets:
+            self._long_header_packets[direction] = self._find_long_header_packets(
+                direction
+            )
+        return list(self._long_header_packets[direction][packet_type])
+
+    def _find_long_header_packets(self, direction: Direction) -> dict:
+        """Get the long header packets of all types, by packet type."""
+        packets = {t: [] for t in WIRESHARK_PACKET_TYPES}
         for packet in self._get_packets(
             self._get_direction_filter(direction)
             + "(quic.long.packet_type || quic.long.packet_type_v2)"
         ):
             for layer in packet.layers:
-                if layer.layer_name == "quic" and (
-                    (
-                        hasattr(layer, "long_packet_type")
-                        and layer.long_packet_type
-                        == WIRESHARK_PACKET_TYPES[packet_type]
-                    )
-                    or (
-                        hasattr(layer, "long_packet_type_v2")
-                        and layer.long_packet_type_v2
-                        == WIRESHARK_PACKET_TYPES_V2[packet_type]
-                    )
-                ):
-                    packets.append(layer)
+                if layer.layer_name != "quic":
+                    continue
+                v1_type = getattr(layer, "long_packet_type", None)
+                v2_type = getattr(layer, "long_packet_type_v2", None)
+                for t in WIRESHARK_PACKET_TYPES:
+                    if (
+                        v1_type == WIRESHARK_PACKET_TYPES[t]
+                        or v2_type == WIRESHARK_PACKET_TYPES_V2[t]
+                    ):
+                        packets[t].append(layer)
         return packets
 
     def get_initial(self, direction: Direction = Direction.ALL) -> List: